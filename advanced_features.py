@@ -3,16 +3,51 @@ Advanced features module for Second Brain AI
 This file contains enhanced functionality that can be gradually added to the main app.
 """
 
+import bisect
+import io
+import itertools
 import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict
 from datetime import datetime
+from pathlib import Path
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+_SENT_RE = re.compile(r'[^.!?]+[.!?]')
+
+
+def _write_json(data, filepath: str):
+    """Write data as indented JSON, using orjson when it is installed."""
+    if orjson is None:
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        return
+    
+    options = (orjson.OPT_INDENT_2 | orjson.OPT_NAIVE_UTC
+               | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    with open(filepath, 'wb') as f:
+        f.write(orjson.dumps(data, option=options))
 
 
 class ConversationHistory:
     """Manages conversation history for context-aware queries."""
     
     def __init__(self, max_history: int = 10):
-        self.history = []
+        self.history = deque(maxlen=max_history)
         self.max_history = max_history
     
     def add_interaction(self, query: str, response: str, sources: List[str]):
@@ -23,33 +58,30 @@ class ConversationHistory:
             "response": response,
             "sources": sources
         }
+        # The bounded deque drops the oldest interaction on overflow
         self.history.append(interaction)
-        
-        # Keep only the most recent interactions
-        if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
     
     def get_context(self, last_n: int = 3) -> str:
         """Get recent conversation context."""
-        recent = self.history[-last_n:] if len(self.history) >= last_n else self.history
-        context = ""
-        for interaction in recent:
-            context += f"Previous Q: {interaction['query']}\n"
-            context += f"Previous A: {interaction['response']}\n\n"
-        return context
+        # deque has no slicing; skip the older entries with islice instead
+        start = max(0, len(self.history) - last_n)
+        return "".join(
+            f"Previous Q: {interaction['query']}\n"
+            f"Previous A: {interaction['response']}\n\n"
+            for interaction in itertools.islice(self.history, start, None)
+        )
     
     def save_to_file(self, filepath: str):
         """Save conversation history to JSON file."""
-        with open(filepath, 'w') as f:
-            json.dump(self.history, f, indent=2)
+        _write_json(list(self.history), filepath)
     
     def load_from_file(self, filepath: str):
         """Load conversation history from JSON file."""
         try:
-            with open(filepath, 'r') as f:
-                self.history = json.load(f)
+            with open(filepath, 'r', encoding='utf-8') as f:
+                self.history = deque(json.load(f), maxlen=self.max_history)
         except FileNotFoundError:
-            self.history = []
+            self.history = deque(maxlen=self.max_history)
 
 
 class DocumentAnalyzer:
@@ -57,22 +89,54 @@ class DocumentAnalyzer:
     
     @staticmethod
     def extract_key_topics(documents: List[str], top_n: int = 5) -> List[str]:
-        """Extract key topics from documents using TF-IDF."""
-        from sklearn.feature_extraction.text import TfidfVectorizer
+        """Extract key topics from documents using hashed TF-IDF."""
+        import numpy as np
+        from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
         
-        vectorizer = TfidfVectorizer(max_features=top_n, stop_words='english')
-        tfidf_matrix = vectorizer.fit_transform(documents)
+        n_features = 2 ** 18
+        vectorizer = HashingVectorizer(
+            n_features=n_features,
+            alternate_sign=False,
+            stop_words='english',
+            norm=None
+        )
+        tfidf_matrix = TfidfTransformer().fit_transform(vectorizer.transform(documents))
         
-        feature_names = vectorizer.get_feature_names_out()
-        return list(feature_names)
+        # Rank hashed buckets by their mean TF-IDF weight
+        scores = np.asarray(tfidf_matrix.mean(axis=0)).ravel()
+        top_buckets = [int(b) for b in np.argsort(scores)[::-1][:top_n] if scores[b] > 0]
+        
+        # Second pass to map the winning buckets back to terms
+        analyzer = vectorizer.build_analyzer()
+        wanted = set(top_buckets)
+        bucket_terms = {}
+        seen_terms = set()
+        for document in documents:
+            terms = [t for t in dict.fromkeys(analyzer(document)) if t not in seen_terms]
+            seen_terms.update(terms)
+            if not terms:
+                continue
+            
+            # Hash the new terms with the vectorizer itself, one row per term
+            term_matrix = vectorizer.transform(terms)
+            for term, lo, hi in zip(terms, term_matrix.indptr[:-1], term_matrix.indptr[1:]):
+                if hi > lo and term_matrix.indices[lo] in wanted:
+                    bucket_terms.setdefault(int(term_matrix.indices[lo]), term)
+            if len(bucket_terms) == len(top_buckets):
+                break
+        
+        return [bucket_terms[b] for b in top_buckets if b in bucket_terms]
     
     @staticmethod
     def summarize_document(text: str, max_sentences: int = 3) -> str:
         """Generate a brief summary of a document."""
-        sentences = text.split('.')
         # Simple extractive summarization - take first few sentences
-        summary_sentences = sentences[:max_sentences]
-        return '. '.join(summary_sentences) + '.'
+        matches = list(itertools.islice(_SENT_RE.finditer(text), max_sentences))
+        
+        # Fewer sentences than requested: keep any unterminated tail as well
+        if len(matches) < max_sentences:
+            return text.strip()
+        return text[:matches[-1].end()].strip() if matches else ''
     
     @staticmethod
     def calculate_readability_score(text: str) -> Dict[str, float]:
@@ -108,46 +172,74 @@ class SmartRetriever:
     @staticmethod
     def filter_by_metadata(documents: List[Dict], filters: Dict) -> List[Dict]:
         """Filter documents based on metadata criteria."""
-        filtered = documents
+        predicates = []
         
         if 'date_range' in filters:
             start, end = filters['date_range']
-            filtered = [d for d in filtered 
-                       if start <= d.get('date', datetime.max) <= end]
+            predicates.append(
+                lambda d: start <= d.get('date', datetime.max) <= end
+            )
         
         if 'source_type' in filters:
-            filtered = [d for d in filtered 
-                       if d.get('source_type') == filters['source_type']]
+            source_type = filters['source_type']
+            predicates.append(lambda d: d.get('source_type') == source_type)
         
-        return filtered
+        return [d for d in documents if all(p(d) for p in predicates)]
+    
+    @staticmethod
+    def filter_sorted_by_date(sorted_docs: List[Dict], start: datetime, end: datetime,
+                              dates: List[datetime] = None) -> List[Dict]:
+        """Return documents dated within [start, end] from a date-sorted list.
+        
+        Callers filtering the same list repeatedly should pass the cached
+        ``dates`` of the documents to avoid rebuilding it on every call.
+        """
+        if dates is None:
+            dates = [d['date'] for d in sorted_docs]
+        lo = bisect.bisect_left(dates, start)
+        hi = bisect.bisect_right(dates, end)
+        return sorted_docs[lo:hi]
 
 
 class ExportManager:
     """Handles exporting data in various formats."""
     
     @staticmethod
-    def export_to_markdown(conversations: List[Dict], filepath: str):
-        """Export conversation history to markdown."""
+    def export_to_markdown(conversations: List[Dict], filepath: str,
+                           flush_every: int = 1000):
+        """Export conversation history to markdown.
+        
+        The buffer is written out every ``flush_every`` conversations;
+        values <= 0 keep everything in memory until the end.
+        """
+        buf = io.StringIO()
+        buf.write("# Second Brain AI - Conversation Export\n\n")
+        buf.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        buf.write("---\n\n")
+        
         with open(filepath, 'w') as f:
-            f.write("# Second Brain AI - Conversation Export\n\n")
-            f.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-            f.write("---\n\n")
-            
             for i, conv in enumerate(conversations, 1):
-                f.write(f"## Query {i}\n\n")
-                f.write(f"**Question:** {conv['query']}\n\n")
-                f.write(f"**Answer:** {conv['response']}\n\n")
+                buf.write(
+                    f"## Query {i}\n\n"
+                    f"**Question:** {conv['query']}\n\n"
+                    f"**Answer:** {conv['response']}\n\n"
+                )
                 if conv.get('sources'):
-                    f.write("**Sources:**\n")
-                    for source in conv['sources']:
-                        f.write(f"- {source}\n")
-                f.write("\n---\n\n")
+                    buf.write("**Sources:**\n")
+                    buf.write("".join(f"- {source}\n" for source in conv['sources']))
+                buf.write("\n---\n\n")
+                
+                # Bound the buffer size for very large exports
+                if flush_every > 0 and i % flush_every == 0:
+                    f.write(buf.getvalue())
+                    buf = io.StringIO()
+            
+            f.write(buf.getvalue())
     
     @staticmethod
     def export_to_json(data: Dict, filepath: str):
         """Export data to JSON format."""
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        _write_json(data, filepath)
     
     @staticmethod
     def create_knowledge_graph(documents: List[Dict]) -> Dict:
@@ -161,6 +253,25 @@ class ExportManager:
         return graph
 
 
+if njit is not None:
+    @njit(cache=True)
+    def _bulk_update(prev_avg, prev_count, times):
+        """Fold a batch of response times into a running mean (Welford update)."""
+        avg = prev_avg
+        count = prev_count
+        for t in times:
+            count += 1
+            avg += (t - avg) / count
+        return avg, count
+else:
+    def _bulk_update(prev_avg, prev_count, times):
+        """Fold a batch of response times into a running mean with numpy."""
+        if times.size == 0:
+            return prev_avg, prev_count
+        count = prev_count + times.size
+        return (prev_avg * prev_count + times.sum()) / count, count
+
+
 class PerformanceMonitor:
     """Monitor and log system performance metrics."""
     
@@ -183,6 +294,18 @@ class PerformanceMonitor:
             (prev_avg * (count - 1) + response_time) / count
         )
     
+    def log_queries(self, response_times: List[float]):
+        """Log a batch of query executions in a single update."""
+        import numpy as np
+        
+        avg, count = _bulk_update(
+            float(self.metrics["avg_response_time"]),
+            self.metrics["query_count"],
+            np.asarray(response_times, dtype=np.float64)
+        )
+        self.metrics["avg_response_time"] = float(avg)
+        self.metrics["query_count"] = int(count)
+    
     def get_stats(self) -> Dict:
         """Get current performance statistics."""
         return self.metrics.copy()
@@ -211,16 +334,66 @@ def add_conversation_memory(query_function):
     return wrapper
 
 
-def batch_process_documents(file_paths: List[str], brain_instance):
-    """Process multiple documents at once."""
+def _parse_file(file_path: str):
+    """Parse one file in a worker process, returning (documents, error)."""
+    try:
+        from app import load_document
+        return load_document(file_path), None
+    except Exception as e:
+        return None, e
+
+
+def batch_process_documents(file_paths: List[str], brain_instance,
+                            max_workers: int = None):
+    """Process multiple documents at once.
+
+    Files are parsed in worker processes (pypdf is pure Python, so threads
+    would serialize on the GIL), then split in this process so the chunks
+    can be embedded and written to the vector store in a single batched
+    pass. Small batches (fewer than 4 files) are parsed serially with
+    ``brain_instance.load_document``.
+    """
+    if len(file_paths) < 4:
+        loaded = []
+        for file_path in file_paths:
+            try:
+                loaded.append((brain_instance.load_document(file_path), None))
+            except Exception as e:
+                loaded.append((None, e))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            loaded = list(executor.map(_parse_file, file_paths))
+
     results = []
-    for file_path in file_paths:
-        success, message = brain_instance.add_to_knowledge_base(file_path)
-        results.append({
-            "file": file_path,
-            "success": success,
-            "message": message
-        })
+    all_texts = []
+    for file_path, (documents, error) in zip(file_paths, loaded):
+        if error is None:
+            try:
+                all_texts.extend(brain_instance.process_documents(documents))
+            except Exception as e:
+                error = e
+        if error is None:
+            results.append({
+                "file": file_path,
+                "success": True,
+                "message": f"Successfully added {Path(file_path).name} to knowledge base"
+            })
+        else:
+            results.append({
+                "file": file_path,
+                "success": False,
+                "message": f"Error processing document: {str(error)}"
+            })
+
+    if all_texts:
+        try:
+            brain_instance.add_texts_to_vectorstore(all_texts)
+            brain_instance.vectorstore.persist()
+        except Exception as e:
+            for result in results:
+                if result["success"]:
+                    result["success"] = False
+                    result["message"] = f"Error processing document: {str(e)}"
     return results
 
 
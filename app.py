@@ -1,6 +1,12 @@
+import asyncio
+import hashlib
 import os
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
 import streamlit as st
 from pathlib import Path
+from uuid import uuid4
 import chromadb
 from chromadb.config import Settings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -10,25 +16,158 @@ from langchain_community.document_loaders import (
     Docx2txtLoader,
 )
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import Chroma
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain_community.llms import Ollama
+from transformers import AutoTokenizer
 import tempfile
 import shutil
 
 
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 64
+ONNX_CACHE_DIR = Path(__file__).resolve().parent / "onnx_models"
+CHUNK_SIZE_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 32
+VECTORSTORE_BATCH_SIZE = 512
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_SIMILARITY = 0.98
+RETRIEVAL_K = 4
+HIGH_CONFIDENCE_SIMILARITY = 0.8
+MAX_SIMILARITY_GAP = 0.15
+
+
+class QuantizedEmbeddings(Embeddings):
+    """INT8-quantized ONNX build of a sentence-transformers embedding model."""
+    
+    def __init__(self, model_name=EMBEDDING_MODEL, cache_dir=ONNX_CACHE_DIR,
+                 batch_size=EMBEDDING_BATCH_SIZE):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        
+        save_dir = Path(cache_dir) / f"{Path(model_name).name}-int8"
+        
+        # Export and quantize the model once, then reuse it from disk
+        if not (save_dir / "model_quantized.onnx").exists():
+            model = ORTModelForFeatureExtraction.from_pretrained(
+                model_name,
+                export=True,
+                provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=save_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(
+                    is_static=False,
+                    per_channel=False
+                )
+            )
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            save_dir,
+            file_name="model_quantized.onnx",
+            provider="CPUExecutionProvider"
+        )
+        # Own instance: the splitter's shared tokenizer is called with
+        # different truncation/padding settings from other threads
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.batch_size = batch_size
+    
+    def _embed(self, texts):
+        """Mean-pool and L2-normalize token embeddings for a list of texts."""
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                return_tensors="np"
+            )
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+    
+    def embed_documents(self, texts):
+        """Embed a list of document chunks."""
+        return self._embed(list(texts))
+    
+    def embed_query(self, text):
+        """Embed a single query string."""
+        return self._embed([text])[0]
+
+
+def load_embeddings():
+    """Load the quantized embedder, falling back to the FP32 model."""
+    try:
+        return QuantizedEmbeddings()
+    except Exception:
+        # optimum missing, or the export/quantization failed (e.g. offline
+        # or an unwritable cache directory)
+        return HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            encode_kwargs={
+                "batch_size": EMBEDDING_BATCH_SIZE,
+                "normalize_embeddings": True,
+            },
+        )
+
+
+@st.cache_resource
+def get_embeddings():
+    """Load the embedding model once per server process."""
+    return load_embeddings()
+
+
+@st.cache_resource
+def get_tokenizer():
+    """Load the embedding model's tokenizer for the text splitter."""
+    return AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+
+
+@st.cache_resource
+def get_llm(llm_model):
+    """Create the Ollama client for a model once per server process."""
+    return Ollama(model=llm_model, temperature=0.7)
+
+
+def load_document(file_path):
+    """Load a document based on its file type.
+    
+    Kept at module level so worker processes can parse files without
+    pickling a SecondBrainAI instance.
+    """
+    file_extension = Path(file_path).suffix.lower()
+    
+    loaders = {
+        '.pdf': PyPDFLoader,
+        '.txt': TextLoader,
+        '.docx': Docx2txtLoader,
+    }
+    
+    if file_extension not in loaders:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+    
+    loader = loaders[file_extension](file_path)
+    documents = loader.load()
+    return documents
+
+
 class SecondBrainAI:
     """Main class for the Second Brain AI application."""
     
-    def __init__(self, persist_directory="./chroma_db"):
+    def __init__(self, persist_directory="./chroma_db", embeddings=None):
         self.persist_directory = persist_directory
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
-        )
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
+        self.embeddings = embeddings if embeddings is not None else load_embeddings()
+        # Measure chunks in MiniLM tokens so embedding batches pad evenly
+        self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            get_tokenizer(),
+            chunk_size=CHUNK_SIZE_TOKENS,
+            chunk_overlap=CHUNK_OVERLAP_TOKENS,
         )
         
         # Initialize or load the vector store
@@ -39,76 +178,188 @@ class SecondBrainAI:
             )
         else:
             self.vectorstore = None
+        
+        # QA chains keyed by LLM model name, and models already loaded by Ollama
+        self._qa_chains = {}
+        self._warmed_models = set()
+        
+        # Query embeddings and retrieved sources for repeated questions
+        self._embed_query = lru_cache(maxsize=QUERY_CACHE_SIZE)(
+            self.embeddings.embed_query
+        )
+        self._retrieval_cache = OrderedDict()
+        self._retrieval_cache_version = None
     
     def load_document(self, file_path):
         """Load a document based on its file type."""
-        file_extension = Path(file_path).suffix.lower()
-        
-        loaders = {
-            '.pdf': PyPDFLoader,
-            '.txt': TextLoader,
-            '.docx': Docx2txtLoader,
-        }
-        
-        if file_extension not in loaders:
-            raise ValueError(f"Unsupported file type: {file_extension}")
-        
-        loader = loaders[file_extension](file_path)
-        documents = loader.load()
-        return documents
+        return load_document(file_path)
     
     def process_documents(self, documents):
-        """Split documents into chunks."""
+        """Split documents into chunks, dropping exact duplicates."""
         texts = self.text_splitter.split_documents(documents)
-        return texts
+        
+        # Repeated headers/footers would otherwise be embedded once per page
+        seen = set()
+        unique_texts = []
+        for text in texts:
+            digest = hashlib.blake2b(text.page_content.encode(), digest_size=8).digest()
+            if digest not in seen:
+                seen.add(digest)
+                unique_texts.append(text)
+        return unique_texts
+    
+    def add_texts_to_vectorstore(self, texts):
+        """Embed chunks in one pass and add them to Chroma in large batches."""
+        self._retrieval_cache.clear()
+        if self.vectorstore is None:
+            self.vectorstore = Chroma(
+                persist_directory=self.persist_directory,
+                embedding_function=self.embeddings
+            )
+        
+        contents = [t.page_content for t in texts]
+        embeddings = self.embeddings.embed_documents(contents)
+        
+        # Write straight to the collection with the precomputed embeddings
+        collection = self.vectorstore._collection
+        for start in range(0, len(texts), VECTORSTORE_BATCH_SIZE):
+            end = start + VECTORSTORE_BATCH_SIZE
+            collection.add(
+                ids=[uuid4().hex for _ in contents[start:end]],
+                embeddings=embeddings[start:end],
+                documents=contents[start:end],
+                metadatas=[t.metadata for t in texts[start:end]]
+            )
     
-    def add_to_knowledge_base(self, file_path):
-        """Add a document to the knowledge base."""
+    def add_to_knowledge_base(self, file_path, persist=True):
+        """Add a document to the knowledge base.
+        
+        Pass ``persist=False`` when adding several files in a row and call
+        ``vectorstore.persist()`` once at the end.
+        """
         try:
             # Load and process the document
             documents = self.load_document(file_path)
             texts = self.process_documents(documents)
             
             # Create or update the vector store
-            if self.vectorstore is None:
-                self.vectorstore = Chroma.from_documents(
-                    documents=texts,
-                    embedding=self.embeddings,
-                    persist_directory=self.persist_directory
-                )
-            else:
-                self.vectorstore.add_documents(texts)
+            self.add_texts_to_vectorstore(texts)
             
             # Persist the changes
-            self.vectorstore.persist()
+            if persist:
+                self.vectorstore.persist()
             
             return True, f"Successfully added {Path(file_path).name} to knowledge base"
         except Exception as e:
             return False, f"Error processing document: {str(e)}"
     
+    def _get_qa_chain(self, llm_model):
+        """Return the question answering chain for a model, building it once."""
+        qa_chain = self._qa_chains.get(llm_model)
+        if qa_chain is None:
+            # Stuff the retrieved sources into a single prompt
+            qa_chain = load_qa_chain(get_llm(llm_model), chain_type="stuff")
+            self._qa_chains[llm_model] = qa_chain
+        return qa_chain
+    
+    def _retrieve(self, query):
+        """Find source documents for a query, reusing cached retrievals."""
+        # Other sessions write to the same collection, so cached sources are
+        # only valid while the collection size is unchanged
+        version = self.vectorstore._collection.count()
+        if version != self._retrieval_cache_version:
+            self._retrieval_cache.clear()
+            self._retrieval_cache_version = version
+        
+        key = " ".join(query.lower().split())
+        cached = self._retrieval_cache.get(key)
+        if cached is not None:
+            self._retrieval_cache.move_to_end(key)
+            return cached[1]
+        
+        embedding = np.asarray(self._embed_query(key))
+        
+        # Embeddings are normalized, so the dot product is the cosine
+        for cached_embedding, documents in self._retrieval_cache.values():
+            if np.dot(embedding, cached_embedding) > QUERY_CACHE_SIMILARITY:
+                return documents
+        
+        results = self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding.tolist(), k=RETRIEVAL_K
+        )
+        documents = self._prune_by_confidence(results)
+        self._retrieval_cache[key] = (embedding, documents)
+        if len(self._retrieval_cache) > QUERY_CACHE_SIZE:
+            self._retrieval_cache.popitem(last=False)
+        return documents
+    
+    @staticmethod
+    def _prune_by_confidence(results):
+        """Keep only the sources that are close to the best match.
+        
+        A confident top hit is sent to the LLM alone; otherwise sources whose
+        similarity trails the top one by more than MAX_SIMILARITY_GAP are
+        dropped, keeping the stuffed prompt short.
+        """
+        if not results:
+            return []
+        
+        # Chroma returns squared L2 distances; on unit vectors cos = 1 - d / 2
+        similarities = [1 - distance / 2 for _, distance in results]
+        if similarities[0] > HIGH_CONFIDENCE_SIMILARITY:
+            return [results[0][0]]
+        return [
+            doc for (doc, _), similarity in zip(results, similarities)
+            if similarities[0] - similarity <= MAX_SIMILARITY_GAP
+        ]
+    
+    @staticmethod
+    def _build_result(query, answer, source_documents):
+        """Package an answer in the shape returned by the query methods."""
+        return {
+            "query": query,
+            "result": answer,
+            "source_documents": source_documents,
+        }
+    
     def query_knowledge_base(self, query, llm_model="llama2"):
         """Query the knowledge base with a question."""
         if self.vectorstore is None:
             return "No documents in knowledge base. Please add documents first."
         
         try:
-            # Initialize the LLM
-            llm = Ollama(model=llm_model, temperature=0.7)
+            qa_chain = self._get_qa_chain(llm_model)
+            source_documents = self._retrieve(query)
             
-            # Create a retrieval QA chain
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=self.vectorstore.as_retriever(
-                    search_kwargs={"k": 4}
-                ),
-                return_source_documents=True
-            )
+            # Get the answer
+            answer = qa_chain.run(input_documents=source_documents, question=query)
+            
+            return self._build_result(query, answer, source_documents)
+        except Exception as e:
+            return f"Error querying knowledge base: {str(e)}"
+    
+    async def aquery_knowledge_base(self, query, llm_model="llama2"):
+        """Query the knowledge base, warming up the LLM while retrieving."""
+        if self.vectorstore is None:
+            return "No documents in knowledge base. Please add documents first."
+        
+        try:
+            qa_chain = self._get_qa_chain(llm_model)
+            
+            # Retrieval and the first Ollama model load are independent,
+            # so overlap them
+            tasks = [asyncio.to_thread(self._retrieve, query)]
+            if llm_model not in self._warmed_models:
+                tasks.append(asyncio.to_thread(get_llm(llm_model).invoke, ""))
+            source_documents, *_ = await asyncio.gather(*tasks)
+            self._warmed_models.add(llm_model)
             
             # Get the answer
-            result = qa_chain({"query": query})
+            answer = await asyncio.to_thread(
+                qa_chain.run, input_documents=source_documents, question=query
+            )
             
-            return result
+            return self._build_result(query, answer, source_documents)
         except Exception as e:
             return f"Error querying knowledge base: {str(e)}"
     
@@ -140,7 +391,7 @@ def main():
     
     # Initialize the Second Brain AI
     if 'brain' not in st.session_state:
-        st.session_state.brain = SecondBrainAI()
+        st.session_state.brain = SecondBrainAI(embeddings=get_embeddings())
     
     # Sidebar for document management
     with st.sidebar:
@@ -156,8 +407,10 @@ def main():
             if st.button("Add to Knowledge Base"):
                 with st.spinner("Processing document..."):
                     # Save the uploaded file temporarily
+                    # Stream the upload in 1 MiB chunks instead of copying it whole
+                    uploaded_file.seek(0)
                     with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp_file:
-                        tmp_file.write(uploaded_file.getvalue())
+                        shutil.copyfileobj(uploaded_file, tmp_file, length=UPLOAD_CHUNK_SIZE)
                         tmp_path = tmp_file.name
                     
                     # Process the document
@@ -205,10 +458,10 @@ def main():
         if st.button("Search Knowledge Base", type="primary"):
             if query:
                 with st.spinner("Searching knowledge base..."):
-                    result = st.session_state.brain.query_knowledge_base(
+                    result = asyncio.run(st.session_state.brain.aquery_knowledge_base(
                         query,
                         llm_model=st.session_state.get('llm_model', 'llama2')
-                    )
+                    ))
                     
                     if isinstance(result, dict) and 'result' in result:
                         st.markdown("### Answer")